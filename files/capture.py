@@ -10,10 +10,66 @@ import subprocess
 from datetime import datetime
 import json
 import os
+import select
+import signal
+import time
+
+# orjson is optional; it decodes AIS-catcher's JSON lines several times faster
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    json_loads = json.loads
 
 DB_PATH = '/home/pi/ais-server/ais_db.sqlite'
 ERROR_LOG = '/home/pi/ais-server/errors.log'
 MAX_LOG_SIZE = 10 * 1024 * 1024  # 10 MB
+BATCH_SIZE = 100  # vessel updates per write
+BATCH_INTERVAL = 1.0  # max seconds between writes
+
+# Shared connection, opened once by open_db()
+_CONN = None
+
+# Vessel columns written from AIS messages, in _UPSERT_SQL parameter order
+# (after mmsi; write_vessels appends timestamp and last_updated)
+VESSEL_FIELDS = (
+    'name', 'latitude', 'longitude', 'speed', 'course', 'heading',
+    'vessel_type', 'callsign', 'destination', 'nav_status',
+)
+
+# Hot-path statements are kept as module constants so every call passes the
+# same SQL text and hits the connection's prepared statement cache.
+
+# Insert a new vessel or merge into the existing row, keeping the stored value
+# for any field missing from the message. Requires SQLite 3.24+.
+_UPSERT_SQL = '''
+    INSERT INTO vessels (
+        mmsi, name, latitude, longitude, speed, course, heading,
+        vessel_type, callsign, destination, nav_status, timestamp, last_updated
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(mmsi) DO UPDATE SET
+        name = COALESCE(NULLIF(excluded.name, ''), name),
+        latitude = COALESCE(excluded.latitude, latitude),
+        longitude = COALESCE(excluded.longitude, longitude),
+        speed = COALESCE(excluded.speed, speed),
+        course = COALESCE(excluded.course, course),
+        heading = COALESCE(excluded.heading, heading),
+        vessel_type = COALESCE(excluded.vessel_type, vessel_type),
+        callsign = COALESCE(excluded.callsign, callsign),
+        destination = COALESCE(excluded.destination, destination),
+        nav_status = COALESCE(excluded.nav_status, nav_status),
+        last_updated = excluded.last_updated
+'''
+
+_DIAG_SQL = '''
+    INSERT OR REPLACE INTO diagnostics (key, value, updated)
+    VALUES (?, ?, ?)
+'''
+
+# Bumped on every vessel write so the web server knows its cache is stale
+_DATA_VERSION_SQL = '''
+    INSERT INTO diagnostics (key, value, updated) VALUES ('data_version', 1, ?)
+    ON CONFLICT(key) DO UPDATE SET value = value + 1, updated = excluded.updated
+'''
 
 def log_error(message):
     """Log error to file with rotation"""
@@ -30,156 +86,202 @@ def log_error(message):
     except Exception as e:
         print(f"Failed to log error: {e}", file=sys.stderr)
 
+def open_db():
+    """Open the shared database connection"""
+    global _CONN
+    _CONN = sqlite3.connect(DB_PATH, isolation_level=None, check_same_thread=False)
+    _CONN.execute('PRAGMA journal_mode=WAL')
+    _CONN.execute('PRAGMA synchronous=NORMAL')
+    _CONN.execute('PRAGMA temp_store=MEMORY')
+    _CONN.execute('PRAGMA cache_size=-20000')  # 20 MB
+
+def reopen_db():
+    """Roll back and reopen the shared connection after an error"""
+    try:
+        if _CONN.in_transaction:
+            _CONN.execute('ROLLBACK')
+        _CONN.close()
+    except sqlite3.Error:
+        pass
+    open_db()
+
+def rollback():
+    """Roll back the open transaction, if any"""
+    try:
+        if _CONN.in_transaction:
+            _CONN.execute('ROLLBACK')
+    except sqlite3.OperationalError as e:
+        log_error(f"Rollback failed, reopening database: {e}")
+        reopen_db()
+
+VESSELS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS {table} (
+        mmsi INTEGER PRIMARY KEY,
+        name TEXT,
+        latitude REAL,
+        longitude REAL,
+        speed REAL,
+        course REAL,
+        heading INTEGER,
+        timestamp INTEGER,
+        vessel_type TEXT,
+        callsign TEXT,
+        imo TEXT,
+        dimension_bow INTEGER,
+        dimension_stern INTEGER,
+        dimension_port INTEGER,
+        dimension_starboard INTEGER,
+        draught REAL,
+        destination TEXT,
+        nav_status TEXT,
+        last_updated INTEGER
+    )
+'''
+
+# Old schema column -> expression converting its values during migration
+MIGRATED_COLUMNS = {
+    'mmsi': 'CAST(mmsi AS INTEGER)',
+    'timestamp': "CASE WHEN typeof(timestamp) = 'text' THEN CAST(strftime('%s', timestamp) AS INTEGER) ELSE timestamp END",
+    'last_updated': "CASE WHEN typeof(last_updated) = 'text' THEN CAST(strftime('%s', last_updated) AS INTEGER) ELSE last_updated END",
+}
+
+def migrate_vessels(c):
+    """Rebuild a vessels table created with TEXT mmsi or ISO-string timestamps"""
+    columns = {row[1]: row[2] for row in c.execute('PRAGMA table_info(vessels)')}
+    if all(columns[name].upper() == 'INTEGER' for name in MIGRATED_COLUMNS):
+        return
+    
+    print("[DB] Migrating vessels table to INTEGER mmsi and timestamps", file=sys.stderr)
+    names = ', '.join(columns)
+    values = ', '.join(MIGRATED_COLUMNS.get(name, name) for name in columns)
+    c.execute('BEGIN')
+    try:
+        c.execute('DROP TABLE IF EXISTS vessels_new')
+        c.execute(VESSELS_TABLE_SQL.format(table='vessels_new'))
+        c.execute(f'''
+            INSERT OR IGNORE INTO vessels_new ({names})
+            SELECT {values} FROM vessels
+            WHERE CAST(mmsi AS INTEGER) > 0
+        ''')
+        c.execute('DROP TABLE vessels')
+        c.execute('ALTER TABLE vessels_new RENAME TO vessels')
+        c.execute('COMMIT')
+    except Exception:
+        c.execute('ROLLBACK')
+        raise
+
 def init_db():
     """Create database if it doesn't exist"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute('''
-            CREATE TABLE IF NOT EXISTS vessels (
-                mmsi TEXT PRIMARY KEY,
-                name TEXT,
-                latitude REAL,
-                longitude REAL,
-                speed REAL,
-                course REAL,
-                heading INTEGER,
-                timestamp TEXT,
-                vessel_type TEXT,
-                callsign TEXT,
-                imo TEXT,
-                dimension_bow INTEGER,
-                dimension_stern INTEGER,
-                dimension_port INTEGER,
-                dimension_starboard INTEGER,
-                draught REAL,
-                destination TEXT,
-                nav_status TEXT,
-                last_updated TEXT
-            )
-        ''')
+        # _UPSERT_SQL needs ON CONFLICT ... DO UPDATE
+        if sqlite3.sqlite_version_info < (3, 24, 0):
+            raise RuntimeError(f"SQLite {sqlite3.sqlite_version} is too old, 3.24+ is required")
+        
+        open_db()
+        c = _CONN.cursor()
+        c.execute(VESSELS_TABLE_SQL.format(table='vessels'))
+        migrate_vessels(c)
         
         # Create diagnostics table
         c.execute('''
             CREATE TABLE IF NOT EXISTS diagnostics (
                 key TEXT PRIMARY KEY,
                 value TEXT,
-                updated TEXT
+                updated INTEGER
             )
         ''')
         
-        conn.commit()
-        conn.close()
+        # Indexes for the web server's recent-vessel query and cleanup
+        c.execute('CREATE INDEX IF NOT EXISTS idx_vessels_last_updated ON vessels (last_updated)')
+        c.execute('''
+            CREATE INDEX IF NOT EXISTS idx_vessels_active ON vessels (last_updated)
+            WHERE latitude IS NOT NULL AND longitude IS NOT NULL
+        ''')
+        c.execute('ANALYZE')
+        
         print("[DB] Database initialized", file=sys.stderr)
     except Exception as e:
         log_error(f"Database init failed: {e}")
         raise
 
-def update_diagnostic(key, value):
+def update_diagnostic(key, value, now=None):
     """Update diagnostic value"""
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        now = datetime.utcnow().isoformat() + 'Z'
-        c.execute('''
-            INSERT OR REPLACE INTO diagnostics (key, value, updated)
-            VALUES (?, ?, ?)
-        ''', (key, str(value), now))
-        conn.commit()
-        conn.close()
+        if now is None:
+            now = int(time.time())
+        _CONN.execute(_DIAG_SQL, (key, str(value), now))
+    except sqlite3.OperationalError as e:
+        log_error(f"Failed to update diagnostic {key}: {e}")
+        reopen_db()
     except Exception as e:
         log_error(f"Failed to update diagnostic {key}: {e}")
 
-def update_vessel(data):
-    """Add or update vessel in database"""
+def update_vessel(data, batch):
+    """Queue vessel update for the next batch write"""
+    mmsi = data.get('mmsi')
+    if not mmsi:
+        return
+    
+    batch.append((mmsi,) + tuple(data.get(field) for field in VESSEL_FIELDS))
+
+def write_vessels(rows, now):
+    """Upsert vessel rows and the last message time in one transaction"""
+    _CONN.execute('BEGIN')
+    _CONN.executemany(_UPSERT_SQL, (row + (now, now) for row in rows))
+    
+    # Update last message time diagnostic, once per batch. Written directly
+    # so a failure here is handled by the caller along with the vessel rows.
+    _CONN.execute(_DIAG_SQL, ('last_message_time', str(now), now))
+    _CONN.execute(_DATA_VERSION_SQL, (now,))
+    _CONN.execute('COMMIT')
+
+def flush_vessels(batch):
+    """Write queued vessel updates in a single transaction"""
+    if not batch:
+        return
+    
+    # One clock read per flush, shared by every row in the batch
+    now = int(time.time())
+    
     try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        
-        mmsi = data.get('mmsi')
-        if not mmsi:
-            conn.close()
-            return
-        
-        now = datetime.utcnow().isoformat() + 'Z'
-        
-        # Check if vessel exists
-        c.execute('SELECT mmsi FROM vessels WHERE mmsi = ?', (mmsi,))
-        exists = c.fetchone()
-        
-        if exists:
-            # Update existing vessel
-            update_fields = []
-            update_values = []
-            
-            if 'name' in data and data['name']:
-                update_fields.append('name = ?')
-                update_values.append(data['name'])
-            if 'latitude' in data:
-                update_fields.append('latitude = ?')
-                update_values.append(data['latitude'])
-            if 'longitude' in data:
-                update_fields.append('longitude = ?')
-                update_values.append(data['longitude'])
-            if 'speed' in data:
-                update_fields.append('speed = ?')
-                update_values.append(data['speed'])
-            if 'course' in data:
-                update_fields.append('course = ?')
-                update_values.append(data['course'])
-            if 'heading' in data:
-                update_fields.append('heading = ?')
-                update_values.append(data['heading'])
-            if 'vessel_type' in data:
-                update_fields.append('vessel_type = ?')
-                update_values.append(data['vessel_type'])
-            if 'callsign' in data:
-                update_fields.append('callsign = ?')
-                update_values.append(data['callsign'])
-            if 'destination' in data:
-                update_fields.append('destination = ?')
-                update_values.append(data['destination'])
-            if 'nav_status' in data:
-                update_fields.append('nav_status = ?')
-                update_values.append(data['nav_status'])
-            
-            update_fields.append('last_updated = ?')
-            update_values.append(now)
-            update_values.append(mmsi)
-            
-            if update_fields:
-                sql = f"UPDATE vessels SET {', '.join(update_fields)} WHERE mmsi = ?"
-                c.execute(sql, update_values)
-        else:
-            # Insert new vessel
-            c.execute('''
-                INSERT INTO vessels (
-                    mmsi, name, latitude, longitude, speed, course, heading,
-                    timestamp, vessel_type, callsign, nav_status, last_updated
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                mmsi,
-                data.get('name', ''),
-                data.get('latitude'),
-                data.get('longitude'),
-                data.get('speed'),
-                data.get('course'),
-                data.get('heading'),
-                now,
-                data.get('vessel_type', ''),
-                data.get('callsign', ''),
-                data.get('nav_status', ''),
-                now
-            ))
-        
-        conn.commit()
-        conn.close()
-        
-        # Update last message time diagnostic
-        update_diagnostic('last_message_time', now)
-        
+        write_vessels(batch, now)
+    except sqlite3.OperationalError as e:
+        log_error(f"Failed to write {len(batch)} vessel updates: {e}")
+        reopen_db()
     except Exception as e:
-        log_error(f"Failed to update vessel {mmsi}: {e}")
+        # A single unbindable row fails the whole batch; retry rows one by one
+        rollback()
+        log_error(f"Failed to write {len(batch)} vessel updates, retrying individually: {e}")
+        for row in batch:
+            try:
+                write_vessels([row], now)
+            except sqlite3.OperationalError as e:
+                log_error(f"Failed to write vessel {row[0]}: {e}")
+                reopen_db()
+                break
+            except Exception as e:
+                rollback()
+                log_error(f"Failed to write vessel {row[0]}: {e}")
+    finally:
+        batch.clear()
+
+def read_lines(stream, timeout, chunk_size=65536):
+    """Yield lines from an unbuffered binary pipe, reading it in large chunks.
+    Yields None whenever timeout() seconds pass with no input (None waits forever)."""
+    pending = b''
+    while True:
+        ready, _, _ = select.select([stream], [], [], timeout())
+        if not ready:
+            yield None
+            continue
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            break
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        yield from lines
+    if pending:
+        yield pending
 
 def main():
     """Main loop - starts AIS-catcher and processes output"""
@@ -220,8 +322,7 @@ def main():
             cmd,
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
-            universal_newlines=True,
-            bufsize=1
+            bufsize=0  # raw pipe, so select() sees every unread byte
         )
     except Exception as e:
         error_msg = f"Failed to start AIS-catcher: {e}"
@@ -231,17 +332,41 @@ def main():
     
     message_count = 0
     last_log_time = datetime.utcnow()
+    batch = []
+    batch_started = 0.0
+    
+    def batch_time_left():
+        """Seconds until the queued batch is due, or None if nothing is queued"""
+        if not batch:
+            return None
+        return max(0.0, BATCH_INTERVAL - (time.monotonic() - batch_started))
+    
+    # systemd stops the service with SIGTERM; exit through the cleanup below
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
     
     try:
-        for line in process.stdout:
-            line = line.strip()
-            if not line or line.startswith('#'):
+        for line in read_lines(process.stdout, batch_time_left):
+            # No input before the batch was due; write it now
+            if line is None:
+                flush_vessels(batch)
+                continue
+            
+            line = line.rstrip(b'\r')
+            if not line or line.startswith(b'#'):
+                continue
+            
+            # Messages without an MMSI are dropped anyway; skip decoding them
+            if b'"mmsi"' not in line:
                 continue
             
             try:
-                data = json.loads(line)
+                data = json_loads(line)
+                
+                mmsi = data.get('mmsi')
+                if not mmsi:
+                    continue
                 
-                vessel_data = {'mmsi': data.get('mmsi')}
+                vessel_data = {'mmsi': int(mmsi)}
                 
                 # Position data
                 if 'lat' in data:
@@ -268,28 +393,38 @@ def main():
                     vessel_data['nav_status'] = data['status']
                 
                 if vessel_data.get('mmsi'):
-                    update_vessel(vessel_data)
+                    if not batch:
+                        batch_started = time.monotonic()
+                    update_vessel(vessel_data, batch)
                     message_count += 1
                     
                     # Log every 100 messages
                     if message_count % 100 == 0:
                         print(f"[DB] Processed {message_count} messages", file=sys.stderr)
                         update_diagnostic('total_messages', message_count)
+                    
+                    # Write vessels in batches rather than once per message
+                    if len(batch) >= BATCH_SIZE or time.monotonic() - batch_started >= BATCH_INTERVAL:
+                        flush_vessels(batch)
                 
-            except json.JSONDecodeError:
+            except json.JSONDecodeError:  # orjson.JSONDecodeError subclasses this
                 continue
             except Exception as e:
                 log_error(f"Error processing message: {e}")
                 continue
     
-    except KeyboardInterrupt:
-        print("\n[AIS Capture] Stopped by user", file=sys.stderr)
+    except (KeyboardInterrupt, SystemExit):
+        print("\n[AIS Capture] Stopped", file=sys.stderr)
+        flush_vessels(batch)
         update_diagnostic('ais_catcher_status', 'Stopped')
         process.terminate()
     except Exception as e:
         log_error(f"Fatal error in main loop: {e}")
+        flush_vessels(batch)
         update_diagnostic('ais_catcher_status', f'ERROR: {e}')
         process.terminate()
+    else:
+        flush_vessels(batch)
 
 if __name__ == '__main__':
     main()
@@ -4,26 +4,119 @@ AIS Web Server - Serves the map and vessel data
 With diagnostics endpoint
 """
 
-from flask import Flask, render_template, jsonify, request
+from flask import Flask, Response, render_template, jsonify, request, g
 import sqlite3
-from datetime import datetime, timedelta
+import json
+import queue
+import glob
 import math
+from itertools import compress
 import os
+import time
+
+# NumPy is optional; it computes distance/bearing for all vessels at once
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# orjson is optional; it serializes the vessel list several times faster
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 app = Flask(__name__)
 DB_PATH = '/home/pi/ais-server/ais_db.sqlite'
 ERROR_LOG = '/home/pi/ais-server/errors.log'
+ERROR_TAIL_BYTES = 4096  # enough for the last 10 log lines
+EARTH_RADIUS_NM = 3440.065
+RETENTION_SECONDS = 48 * 3600  # keep vessels for 48 hours
+RTL_SDR_USB_IDS = {('0bda', '2832'), ('0bda', '2838')}  # Realtek RTL2832U
+RTL_SDR_CACHE_TTL = 10  # seconds
+VESSELS_CACHE_TTL = 30  # seconds, bounds drift past the 48 hour cutoff
+
+# /api/vessels fields, in SELECT order. imo, dimensions and draught are never
+# captured, so they are left out; timestamp is last_updated in Unix seconds.
+VESSEL_COLUMNS = (
+    'mmsi', 'name', 'latitude', 'longitude', 'speed', 'course', 'heading',
+    'timestamp', 'vessel_type', 'callsign', 'destination', 'nav_status',
+)
+
+# Idle read-only connections, reused across requests
+_db_pool = queue.SimpleQueue()
+
+# (connected, expires) from the last USB scan
+_rtl_sdr_cache = (False, 0)
+
+# (my_lat, my_lon, radius_nm) -> (created, data_version, JSON bytes)
+_vessels_cache = {}
 
 def get_db():
-    """Connect to database"""
+    """Get this request's read-only database connection"""
+    if 'db' not in g:
+        try:
+            g.db = _db_pool.get_nowait()
+        except queue.Empty:
+            g.db = sqlite3.connect(f'file:{DB_PATH}?mode=ro', uri=True, check_same_thread=False)
+            g.db.row_factory = sqlite3.Row
+    return g.db
+
+@app.teardown_appcontext
+def release_db(exc):
+    """Return the request's connection to the pool"""
+    db = g.pop('db', None)
+    if db is not None:
+        _db_pool.put(db)
+
+def get_writable_db():
+    """Connect to database for writing"""
     conn = sqlite3.connect(DB_PATH)
     conn.row_factory = sqlite3.Row
     return conn
 
+def iso_utc(timestamp):
+    """Format a Unix timestamp as an ISO 8601 UTC string"""
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp))
+
+def read_sysfs(path):
+    """Read a sysfs attribute, or None if it can't be read"""
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def rtl_sdr_connected():
+    """Check sysfs for an RTL-SDR dongle, caching the result briefly"""
+    global _rtl_sdr_cache
+    connected, expires = _rtl_sdr_cache
+    now = time.monotonic()
+    if now < expires:
+        return connected
+    
+    connected = False
+    for device in glob.glob('/sys/bus/usb/devices/*/'):
+        ids = (read_sysfs(device + 'idVendor'), read_sysfs(device + 'idProduct'))
+        if ids in RTL_SDR_USB_IDS:
+            connected = True
+            break
+    
+    _rtl_sdr_cache = (connected, now + RTL_SDR_CACHE_TTL)
+    return connected
+
+def to_json(data):
+    """Serialize data to JSON bytes, using orjson when available"""
+    if orjson is None:
+        return json.dumps(data).encode()
+    return orjson.dumps(data)
+
+def json_response(body):
+    """Wrap serialized JSON bytes in a response"""
+    return Response(body, mimetype='application/json')
+
 def calculate_distance(lat1, lon1, lat2, lon2):
     """Calculate distance in nautical miles"""
-    R = 3440.065  # Earth radius in nautical miles
-    
     lat1_rad = math.radians(lat1)
     lat2_rad = math.radians(lat2)
     delta_lat = math.radians(lat2 - lat1)
@@ -32,7 +125,7 @@ def calculate_distance(lat1, lon1, lat2, lon2):
     a = math.sin(delta_lat/2)**2 + math.cos(lat1_rad) * math.cos(lat2_rad) * math.sin(delta_lon/2)**2
     c = 2 * math.asin(math.sqrt(a))
     
-    return R * c
+    return EARTH_RADIUS_NM * c
 
 def calculate_bearing(lat1, lon1, lat2, lon2):
     """Calculate bearing in degrees"""
@@ -46,6 +139,37 @@ def calculate_bearing(lat1, lon1, lat2, lon2):
     bearing = math.degrees(math.atan2(y, x))
     return (bearing + 360) % 360
 
+def calculate_distances_bearings(lat1, lon1, lats, lons):
+    """Calculate distances (NM) and bearings (degrees) to many points with NumPy"""
+    lat1_rad = math.radians(lat1)
+    lat2_rad = np.radians(lats)
+    delta_lat = lat2_rad - lat1_rad
+    delta_lon = np.radians(lons) - math.radians(lon1)
+    cos_lat2 = np.cos(lat2_rad)
+    
+    a = np.sin(delta_lat/2)**2 + math.cos(lat1_rad) * cos_lat2 * np.sin(delta_lon/2)**2
+    distances = EARTH_RADIUS_NM * 2 * np.arcsin(np.sqrt(a))
+    
+    y = np.sin(delta_lon) * cos_lat2
+    x = math.cos(lat1_rad) * np.sin(lat2_rad) - math.sin(lat1_rad) * cos_lat2 * np.cos(delta_lon)
+    bearings = (np.degrees(np.arctan2(y, x)) + 360) % 360
+    
+    return distances, bearings
+
+def bounding_box(lat, lon, radius_nm):
+    """Lat/lon box around a point containing the given radius (NM).
+    Longitude bounds are None when the box would cross a pole or the antimeridian."""
+    lat_delta = radius_nm / 60.0  # 1 minute of latitude = 1 NM
+    min_lat, max_lat = lat - lat_delta, lat + lat_delta
+    if min_lat <= -90 or max_lat >= 90:
+        return min_lat, max_lat, None, None
+    
+    lon_delta = lat_delta / math.cos(math.radians(max(abs(min_lat), abs(max_lat))))
+    if lon - lon_delta < -180 or lon + lon_delta > 180:
+        return min_lat, max_lat, None, None
+    
+    return min_lat, max_lat, lon - lon_delta, lon + lon_delta
+
 @app.route('/')
 def index():
     """Serve main page"""
@@ -53,57 +177,89 @@ def index():
 
 @app.route('/api/vessels')
 def get_vessels():
-    """Get all vessels from last 48 hours"""
+    """Get all vessels from last 48 hours, optionally within radius_nm of my position.
+    Returns one array per field (mmsi, name, ...), all in the same vessel order."""
     my_lat = request.args.get('my_lat', type=float)
     my_lon = request.args.get('my_lon', type=float)
+    radius_nm = request.args.get('radius_nm', type=float)
+    if my_lat is None or my_lon is None:
+        radius_nm = None
     
     conn = get_db()
     c = conn.cursor()
+    c.row_factory = None  # plain tuples, indexed by position below
+    
+    # Reuse the last response for this position until capture writes a batch
+    c.execute("SELECT value FROM diagnostics WHERE key = 'data_version'")
+    version = c.fetchone()
+    version = version[0] if version else None
+    key = (
+        None if my_lat is None else round(my_lat, 3),
+        None if my_lon is None else round(my_lon, 3),
+        radius_nm,
+    )
+    now = time.monotonic()
+    entry = _vessels_cache.get(key)
+    if entry and entry[1] == version and now - entry[0] < VESSELS_CACHE_TTL:
+        return json_response(entry[2])
     
     # Get vessels from last 48 hours
-    cutoff = (datetime.utcnow() - timedelta(hours=48)).isoformat() + 'Z'
-    c.execute('''
-        SELECT * FROM vessels 
+    cutoff = int(time.time()) - RETENTION_SECONDS
+    sql = '''
+        SELECT mmsi, name, latitude, longitude, speed, course, heading,
+               last_updated, vessel_type, callsign, destination, nav_status
+        FROM vessels 
         WHERE latitude IS NOT NULL 
         AND longitude IS NOT NULL
         AND last_updated > ?
-        ORDER BY last_updated DESC
-    ''', (cutoff,))
-    
-    vessels = []
-    for row in c.fetchall():
-        vessel = {
-            'mmsi': row['mmsi'],
-            'name': row['name'] or 'Unknown',
-            'latitude': row['latitude'],
-            'longitude': row['longitude'],
-            'speed': row['speed'],
-            'course': row['course'],
-            'heading': row['heading'],
-            'timestamp': row['last_updated'],
-            'vessel_type': row['vessel_type'] or '',
-            'callsign': row['callsign'] or '',
-            'imo': row['imo'] or '',
-            'dimension_bow': row['dimension_bow'],
-            'dimension_stern': row['dimension_stern'],
-            'dimension_port': row['dimension_port'],
-            'dimension_starboard': row['dimension_starboard'],
-            'draught': row['draught'],
-            'destination': row['destination'] or '',
-            'nav_status': row['nav_status'] or '',
-        }
-        
-        # Calculate distance if user position provided
-        if my_lat is not None and my_lon is not None:
-            vessel['distance'] = round(calculate_distance(my_lat, my_lon, 
-                                                         row['latitude'], row['longitude']), 2)
-            vessel['bearing'] = round(calculate_bearing(my_lat, my_lon,
-                                                       row['latitude'], row['longitude']), 1)
+    '''
+    params = [cutoff]
+    
+    # Pre-filter to a bounding box so far-away rows never leave SQLite
+    if radius_nm is not None:
+        min_lat, max_lat, min_lon, max_lon = bounding_box(my_lat, my_lon, radius_nm)
+        sql += ' AND latitude BETWEEN ? AND ?'
+        params += [min_lat, max_lat]
+        if min_lon is not None:
+            sql += ' AND longitude BETWEEN ? AND ?'
+            params += [min_lon, max_lon]
+    
+    c.execute(sql + ' ORDER BY last_updated DESC', params)
+    
+    rows = c.fetchall()
+    
+    # Calculate distance if user position provided
+    distances = bearings = None
+    if my_lat is not None and my_lon is not None:
+        if np is not None:
+            lats = np.fromiter((row[2] for row in rows), dtype=np.float64, count=len(rows))
+            lons = np.fromiter((row[3] for row in rows), dtype=np.float64, count=len(rows))
+            distances, bearings = calculate_distances_bearings(my_lat, my_lon, lats, lons)
+            distances = np.round(distances, 2).tolist()
+            bearings = np.round(bearings, 1).tolist()
+        else:
+            distances = [round(calculate_distance(my_lat, my_lon, row[2], row[3]), 2) for row in rows]
+            bearings = [round(calculate_bearing(my_lat, my_lon, row[2], row[3]), 1) for row in rows]
         
-        vessels.append(vessel)
+        # Drop the bounding box corners outside the actual radius
+        if radius_nm is not None:
+            keep = [distance <= radius_nm for distance in distances]
+            rows = list(compress(rows, keep))
+            distances = list(compress(distances, keep))
+            bearings = list(compress(bearings, keep))
     
-    conn.close()
-    return jsonify(vessels)
+    # One array per field rather than one object per vessel
+    columns = dict(zip(VESSEL_COLUMNS, zip(*rows))) if rows else {name: [] for name in VESSEL_COLUMNS}
+    if distances is not None:
+        columns['distance'] = distances
+        columns['bearing'] = bearings
+    
+    body = to_json(columns)
+    # Snapshot first: other server threads may add entries while we prune
+    for stale in [k for k, e in list(_vessels_cache.items()) if now - e[0] >= VESSELS_CACHE_TTL]:
+        _vessels_cache.pop(stale, None)
+    _vessels_cache[key] = (now, version, body)
+    return json_response(body)
 
 @app.route('/api/diagnostics')
 def get_diagnostics():
@@ -127,25 +283,31 @@ def get_diagnostics():
         diagnostics = {row['key']: row['value'] for row in diag_rows}
         
         # Check for RTL-SDR
-        rtl_sdr_connected = os.system('lsusb | grep -q RTL2832U') == 0
+        rtl_sdr = rtl_sdr_connected()
         
         # Get last message time
         last_msg_time = diagnostics.get('last_message_time', 'Never')
         if last_msg_time != 'Never':
             try:
-                last_msg_dt = datetime.fromisoformat(last_msg_time.replace('Z', ''))
-                seconds_ago = (datetime.utcnow() - last_msg_dt).total_seconds()
+                last_msg_ts = int(last_msg_time)
+                last_msg_time = iso_utc(last_msg_ts)
+                seconds_ago = time.time() - last_msg_ts
             except:
                 seconds_ago = 999999
         else:
             seconds_ago = 999999
         
-        # Get errors from log (last 10 lines)
+        # Get errors from log (last 10 lines, read from the end of the file)
         errors = []
         if os.path.exists(ERROR_LOG):
             try:
-                with open(ERROR_LOG, 'r') as f:
-                    lines = f.readlines()
+                with open(ERROR_LOG, 'rb') as f:
+                    f.seek(0, os.SEEK_END)
+                    start = max(0, f.tell() - ERROR_TAIL_BYTES)
+                    f.seek(start)
+                    lines = f.read().decode('utf-8', 'replace').splitlines()
+                    if start > 0:
+                        lines = lines[1:]  # first line is probably cut off
                     errors = [line.strip() for line in lines[-10:]]
             except:
                 pass
@@ -156,13 +318,12 @@ def get_diagnostics():
             'db_size_mb': round(db_size, 2),
             'last_message': last_msg_time,
             'seconds_since_message': int(seconds_ago),
-            'rtl_sdr_connected': rtl_sdr_connected,
+            'rtl_sdr_connected': rtl_sdr,
             'ais_catcher_status': diagnostics.get('ais_catcher_status', 'Unknown'),
             'total_messages': diagnostics.get('total_messages', 0),
             'recent_errors': errors[-3:] if errors else []
         }
         
-        conn.close()
         return jsonify(status)
         
     except Exception as e:
@@ -176,17 +337,26 @@ def get_diagnostics():
 @app.route('/api/cleanup')
 def cleanup_old_data():
     """Remove vessels older than 48 hours"""
-    conn = get_db()
+    conn = get_writable_db()
     c = conn.cursor()
     
-    cutoff = (datetime.utcnow() - timedelta(hours=48)).isoformat() + 'Z'
+    cutoff = int(time.time()) - RETENTION_SECONDS
     c.execute('DELETE FROM vessels WHERE last_updated < ?', (cutoff,))
     deleted = c.rowcount
     
     conn.commit()
     conn.close()
     
+    if deleted:
+        _vessels_cache.clear()
+    
     return jsonify({'deleted': deleted})
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=80, debug=False)
+    # Prefer waitress's worker threads; the Werkzeug dev server is the fallback
+    try:
+        from waitress import serve
+    except ImportError:
+        app.run(host='0.0.0.0', port=80, debug=False, threaded=True)
+    else:
+        serve(app, host='0.0.0.0', port=80, threads=4)
@@ -126,6 +126,11 @@ if ! is_complete "step2_dependencies"; then
     # Python and web server
     retry "apt install -y python3-pip python3-flask sqlite3" || exit 1
     
+    # Optional speedups - the Python scripts fall back without them
+    apt install -y python3-orjson || warning "python3-orjson not available, using stdlib json"
+    apt install -y python3-numpy || warning "python3-numpy not available, using pure-Python distance math"
+    apt install -y python3-waitress || warning "python3-waitress not available, using Flask's built-in server"
+    
     # WiFi hotspot
     retry "apt install -y hostapd dnsmasq" || exit 1
     
@@ -352,14 +357,14 @@ conn = sqlite3.connect(DB_PATH)
 c = conn.cursor()
 c.execute('''
     CREATE TABLE IF NOT EXISTS vessels (
-        mmsi TEXT PRIMARY KEY,
+        mmsi INTEGER PRIMARY KEY,
         name TEXT,
         latitude REAL,
         longitude REAL,
         speed REAL,
         course REAL,
         heading INTEGER,
-        timestamp TEXT,
+        timestamp INTEGER,
         vessel_type TEXT,
         callsign TEXT,
         imo TEXT,
@@ -370,7 +375,7 @@ c.execute('''
         draught REAL,
         destination TEXT,
         nav_status TEXT,
-        last_updated TEXT
+        last_updated INTEGER
     )
 ''')
 conn.commit()